@@ -1,4 +1,3 @@
-import torch
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 
@@ -37,14 +36,13 @@ class Caption:
             .unsqueeze(0)
             .to(self.device)
         )
-        with torch.no_grad():
-            caption = self.model.generate(
-                gpu_image,
-                sample=sample,
-                num_beams=num_beams,
-                max_length=max_length,
-                min_length=min_length,
-                top_p=top_p,
-                repetition_penalty=repetition_penalty,
-            )[0]
+        caption = self.model.generate(
+            gpu_image,
+            sample=sample,
+            num_beams=num_beams,
+            max_length=max_length,
+            min_length=min_length,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )[0]
         return caption
@@ -1,9 +1,12 @@
+import os
 import sys
+
 import torch
 from typing import Literal
 
 from nataili.model_manager import ModelManager
-from nataili.modules import blip_decoder
+from nataili.modules import blip_decoder, load_checkpoint
+from nataili.util import convert_to_safetensors
 if sys.version_info < (3, 9):
     # importlib.resources either doesn't exist or lacks the files()
     # function, so use the PyPI version:
@@ -26,16 +29,30 @@ class BLIPModelManager(ModelManager):
         gpu_id: int = 0,
         blip_image_eval_size: int = 512,
     ):
-        vit = "base" if model_name == "BLIP" else "large"
-        model_path = self.get_model_files(model_name)[0]["path"]
         device = torch.device(f"cuda:{gpu_id}") if device == "cuda" else torch.device("cpu")
-        model = blip_decoder(
-            pretrained=model_path,
-            med_config=pkg / "model_manager" / "med_config.json",
-            image_size=blip_image_eval_size,
-            vit=vit,
-        )
-        model = model.eval()
-        model = (model if precision == "fp32" else model.half()).to(device)
+        dtype = torch.float32 if precision == "fp32" else torch.float16
+        loaded = self.loaded_models.get(model_name)
+        if loaded:
+            if loaded["device"] == device and next(loaded["model"].parameters()).dtype == dtype:
+                return True
+            # free the previous copy before building the new one
+            self.unload_model(model_name)
+        vit = "base" if model_name == "BLIP" else "large"
+        model_path = os.path.join(self.model_base_path, self.get_model_files(model_name)[0]["path"])
+        # The .pth checkpoint is converted once, later loads memory map the .safetensors copy
+        model_path = convert_to_safetensors(model_path, key="model") or model_path
+        # Parameters and buffers are created on the meta device, which only affects this thread, then filled in
+        # module by module from the memory mapped checkpoint directly on the device in the target precision.
+        with torch.device("meta"):
+            model = blip_decoder(
+                med_config=pkg / "model_manager" / "med_config.json",
+                image_size=blip_image_eval_size,
+                vit=vit,
+            )
+        model, msg = load_checkpoint(model, model_path, device=device, dtype=dtype)
+        if msg.missing_keys:
+            raise RuntimeError(f"{model_path} is missing {msg.missing_keys}")
+        model.eval()
+        model.requires_grad_(False)
         self.loaded_models[model_name] = {"model": model, "device": device}
         return True
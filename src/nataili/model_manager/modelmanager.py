@@ -1,17 +1,41 @@
+import copy
+import gc
 import hashlib
 import json
 import os
 import shutil
 import sys
+import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import zip_longest
 from typing import Dict, List, Literal, Optional, Tuple, Union
+from urllib.parse import urlparse
 
 import git
 import requests
+import torch
 from tqdm import tqdm
 
 from nataili.util import logger
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    from huggingface_hub import snapshot_download
+except ImportError:
+    snapshot_download = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 if sys.version_info < (3, 9):
     # importlib.resources either doesn't exist or lacks the files()
     # function, so use the PyPI version:
@@ -22,30 +46,109 @@ else:
 
 pkg = importlib_resources.files("nataili")
 
-models = json.load(open(pkg / "db.json"))
-dependencies = json.load(open(pkg / "db_dep.json"))
+
+@lru_cache(maxsize=None)
+def _load_json(path):
+    """Parse a bundled json file once per process"""
+    return json_loads(path.read_bytes())
+
+
+# Parsed once and shared by every ModelManager, each instance gets a shallow copy of the top level
+models = _load_json(pkg / "db.json")
+dependencies = _load_json(pkg / "db_dep.json")
 remote_models = "https://raw.githubusercontent.com/Sygil-Dev/nataili-model-reference/main/db.json"
 remote_dependencies = "https://raw.githubusercontent.com/Sygil-Dev/nataili-model-reference/main/db_dep.json"
+download_chunk_size = 1024 * 1024
+download_threads = 8
+# seconds to wait for a connection or for the next bytes of a response
+download_timeout = 30
+# every ModelManager writing the validation sidecar goes through this lock
+_validated_lock = threading.Lock()
+
+
+class _RangesIgnored(Exception):
+    """The server answered a Range request with something other than the requested range"""
+
+
+def _hashable(value):
+    """Turns the lists and dicts of the model reference into something usable as a dict key"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def is_huggingface_url(url):
+    return urlparse(url).hostname in ("huggingface.co", "hf.co")
+
+
+def _list_dir(path):
+    """Names in a directory, one syscall instead of a stat per file we look for"""
+    try:
+        with os.scandir(path) as entries:
+            # dangling symlinks are not there as far as os.path.exists is concerned
+            return frozenset(entry.name for entry in entries if not entry.is_symlink() or os.path.exists(entry.path))
+    except (FileNotFoundError, NotADirectoryError):
+        return frozenset()
+
+
+def split_ranges(total, parts):
+    """Inclusive (start, end) byte ranges covering `total` bytes in at most `parts` pieces"""
+    range_size = -(-total // parts)
+    return [(start, min(start + range_size, total) - 1) for start in range(0, total, range_size)]
+
+
+def extract_subfolder(zip_ref, prefix, destination):
+    """Writes the members of `zip_ref` under `prefix` to `destination`, members escaping it are skipped"""
+    destination = os.path.realpath(destination)
+    for member in zip_ref.infolist():
+        if not member.filename.startswith(prefix) or member.is_dir():
+            continue
+        target = os.path.realpath(os.path.join(destination, member.filename[len(prefix) :]))
+        if os.path.commonpath([destination, target]) != destination:
+            logger.warning(f"Skipping {member.filename}, it would be extracted outside of {destination}")
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with zip_ref.open(member) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=download_chunk_size)
+
+
+def file_digest(file_obj, digest):
+    """hashlib.file_digest, with a chunked fallback for Python < 3.11"""
+    if hasattr(hashlib, "file_digest"):
+        return hashlib.file_digest(file_obj, digest)
+    # Python < 3.11
+    file_hash = hashlib.new(digest)
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    while size := file_obj.readinto(buffer):
+        file_hash.update(view[:size])
+    return file_hash
 
 
 class ModelManager:
     def __init__(self, model_base_path=None, hf_auth=None, download=True, disable_voodoo=True):
+        self.model_base_path = model_base_path if model_base_path else os.path.join(os.path.expanduser('~'), '.nataili')
+        if not os.path.exists(self.model_base_path):
+            os.makedirs(self.model_base_path)
         if download:
             try:
                 logger.init("Model Reference", status="Downloading")
-                r = requests.get(remote_models)
-                self.models = r.json()
-                r = requests.get(remote_dependencies)
-                self.dependencies = json.load(open(pkg / "db_dep.json"))
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    models_future = executor.submit(self.download_reference, remote_models)
+                    dependencies_future = executor.submit(self.download_reference, remote_dependencies)
+                self.models = models_future.result()
+                self.dependencies = dependencies_future.result()
                 logger.init_ok("Model Reference", status="OK")
             except Exception:
                 logger.init_err("Model Reference", status="Download Error")
-                self.models = json.load(open(pkg / "db.json"))
-                self.dependencies = json.load(open(pkg / "db_dep.json"))
+                self.models = copy.copy(models)
+                self.dependencies = copy.copy(dependencies)
                 logger.init_warn("Model Reference", status="Local")
         else:
-            self.models = json.load(open(pkg / "db.json"))
-            self.dependencies = json.load(open(pkg / "db_dep.json"))
+            self.models = copy.copy(models)
+            self.dependencies = copy.copy(dependencies)
         self.available_models = []
         self.tainted_models = []
         self.available_dependencies = []
@@ -53,20 +156,82 @@ class ModelManager:
         self.hf_auth = None
         self.set_authentication(hf_auth)
         self.disable_voodoo = disable_voodoo
-        self.model_base_path = model_base_path if model_base_path else os.path.join(os.path.expanduser('~'), '.nataili')
-        if not os.path.exists(self.model_base_path):
-            os.makedirs(self.model_base_path)
+        # Directory listings for the bulk scan in init(), rebuilt on every init()
+        self._dir_listing = lru_cache(maxsize=None)(_list_dir)
+        # Checksums of files which passed validation, by path, along with the size and mtime they had
+        self._validated_path = os.path.join(self.model_base_path, ".validated.json")
+        try:
+            with open(self._validated_path, "rb") as f:
+                self._validated = json_loads(f.read())
+        except (OSError, ValueError):
+            self._validated = {}
+
+    def download_reference(self, url):
+        """Downloads a model reference db.
+        The last download is kept with its ETag, an unchanged reference is answered with a 304 and read from disk.
+        """
+        reference_path = os.path.join(self.model_base_path, "reference", os.path.basename(url))
+        etag_path = f"{reference_path}.etag"
+        headers = {}
+        if os.path.exists(reference_path) and os.path.exists(etag_path):
+            with open(etag_path) as f:
+                headers["If-None-Match"] = f.read()
+        r = requests.get(url, headers=headers, timeout=5)
+        if r.status_code == 304:
+            with open(reference_path, "rb") as f:
+                return json_loads(f.read())
+        r.raise_for_status()
+        reference = json_loads(r.content)
+        if "etag" in r.headers:
+            os.makedirs(os.path.dirname(reference_path), exist_ok=True)
+            with open(f"{reference_path}.tmp", "wb") as f:
+                f.write(r.content)
+            os.replace(f"{reference_path}.tmp", reference_path)
+            with open(etag_path, "w") as f:
+                f.write(r.headers["etag"])
+        return reference
+
+    @property
+    def models(self):
+        return self._models
+
+    @models.setter
+    def models(self, models):
+        self._models = models
+        self._attr_index = None
+        self._files_by_model = None
+
+    def _build_files_by_model(self):
+        """Full paths of the files of every model, diffusers models have none to check"""
+        self._files_by_model = {
+            model_name: tuple(
+                os.path.join(self.model_base_path, file["path"]) for file in model.get("config", {}).get("files", [])
+            )
+            for model_name, model in self.models.items()
+            if model.get("type") != "diffusers"
+        }
+
+    def _build_index(self):
+        """Index model names by every (keyword, value) pair of their reference entry"""
+        self._attr_index = {}
+        for model_name, model in self.models.items():
+            for keyword, value in model.items():
+                self._attr_index.setdefault((keyword, _hashable(value)), set()).add(model_name)
 
     def init(self):
+        self._dir_listing.cache_clear()
+        if self._files_by_model is None:
+            self._build_files_by_model()
         dependencies_available = []
         for dependency in self.dependencies:
-            if self.check_available(self.get_dependency_files(dependency)):
+            files = self.get_dependency_files(dependency)
+            if all(self._file_listed(os.path.join(self.model_base_path, file["path"])) for file in files):
                 dependencies_available.append(dependency)
         self.available_dependencies = dependencies_available
 
         models_available = []
         for model in self.models:
-            if self.check_available(self.get_model_files(model)):
+            if all(map(self._file_listed, self._files_by_model.get(model, ()))):
                 models_available.append(model)
         self.available_models = models_available
 
@@ -98,15 +263,19 @@ class ModelManager:
         """Get all model names.
         Can filter based on metadata of the model reference db
         """
-        filtered_models = self.models
-        for keyword in kwargs:
-            iterating_models = filtered_models.copy()
-            filtered_models = {}
-            for model in iterating_models:
-                # logger.debug([keyword,iterating_models[model].get(keyword),kwargs[keyword]])
-                if iterating_models[model].get(keyword) == kwargs[keyword]:
-                    filtered_models[model] = iterating_models[model]
-        return filtered_models
+        if not kwargs:
+            return self.models
+        if self._attr_index is None:
+            self._build_index()
+        matches = []
+        for keyword, value in kwargs.items():
+            if value is None:
+                # entries without the keyword match None as well, those are not in the index
+                matches.append({model for model in self.models if self.models[model].get(keyword) is None})
+            else:
+                matches.append(self._attr_index.get((keyword, _hashable(value)), set()))
+        filtered_names = set.intersection(*matches)
+        return {model: self.models[model] for model in self.models if model in filtered_names}
 
     def get_filtered_model_names(self, **kwargs):
         filtered_models = self.get_filtered_models(**kwargs)
@@ -146,15 +315,27 @@ class ModelManager:
 
     def unload_model(self, model_name):
         if model_name in self.loaded_models:
+            # move off the GPU first, callers may still hold a reference to the model
+            self.loaded_models[model_name]["model"].to("cpu")
             del self.loaded_models[model_name]
+            self.empty_cache()
             return True
         return False
 
     def unload_all_models(self):
-        for model in self.loaded_models:
-            del self.loaded_models[model]
+        for entry in self.loaded_models.values():
+            entry["model"].to("cpu")
+        self.loaded_models.clear()
+        self.empty_cache()
         return True
 
+    def empty_cache(self):
+        """Give the memory of unloaded models back, the CUDA allocator keeps it cached otherwise"""
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+
     def taint_model(self, model_name):
         """Marks a model as not valid by remiving it from available_models"""
         if model_name in self.available_models:
@@ -170,25 +351,73 @@ class ModelManager:
         for file_details in files:
             if not self.check_file_available(file_details["path"]):
                 return False
-            if not self.validate_file(file_details):
-                return False
-        return True
+        if not files:
+            return True
+        # Multi-file models are hashed in parallel
+        with ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+            return all(executor.map(self.validate_file, files))
 
     def validate_file(self, file_details):
-        if "md5sum" in file_details:
-            file_name = file_details["path"]
-            logger.debug(f"Getting md5sum of {file_name}")
+        """Checks the file against its sha256, blake3 or md5 sum, unchanged files that passed before are not rehashed"""
+        if "sha256sum" in file_details:
+            algorithm = "sha256"
+        elif "blake3sum" in file_details and blake3 is not None:
+            algorithm = "blake3"
+        elif "md5sum" in file_details:
+            algorithm = "md5"
+        elif "blake3sum" in file_details:
+            logger.warning(f"{file_details['path']} only has a blake3sum, install blake3 to check it")
+            return True
+        else:
+            return True
+        expected = file_details[f"{algorithm}sum"]
+        file_name = os.path.join(self.model_base_path, file_details["path"])
+        stat = os.stat(file_name)
+        validated = self._validated.get(file_name)
+        if (
+            validated
+            and validated["size"] == stat.st_size
+            and validated["mtime_ns"] == stat.st_mtime_ns
+            and validated.get(algorithm) == expected
+        ):
+            return True
+        logger.debug(f"Getting {algorithm}sum of {file_name}")
+        if algorithm == "blake3":
+            digest = blake3.blake3(max_threads=blake3.blake3.AUTO).update_mmap(file_name).hexdigest()
+        else:
             with open(file_name, "rb") as file_to_check:
-                file_hash = hashlib.md5()
-                while chunk := file_to_check.read(8192):
-                    file_hash.update(chunk)
-            if file_details["md5sum"] != file_hash.hexdigest():
-                return False
-        return True
+                digest = file_digest(file_to_check, algorithm).hexdigest()
+        if digest == expected:
+            self.remember_validated(file_name, stat, algorithm, digest)
+        return digest == expected
+
+    def remember_validated(self, file_name, stat, algorithm, digest):
+        """Records a validated file in the sidecar cache, keyed on its size and mtime"""
+        with _validated_lock:
+            # other managers sharing model_base_path may have recorded files since we loaded the sidecar
+            try:
+                with open(self._validated_path, "rb") as f:
+                    self._validated.update(json_loads(f.read()))
+            except (OSError, ValueError):
+                pass
+            validated = self._validated.get(file_name)
+            if not validated or validated["size"] != stat.st_size or validated["mtime_ns"] != stat.st_mtime_ns:
+                validated = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            self._validated[file_name] = {**validated, algorithm: digest}
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.model_base_path, prefix=".validated.", suffix=".tmp", delete=False
+            ) as f:
+                json.dump(self._validated, f)
+            os.replace(f.name, self._validated_path)
 
     def check_file_available(self, file_path):
         return os.path.exists(os.path.join(self.model_base_path, file_path))
 
+    def _file_listed(self, file_path):
+        """check_file_available against the cached directory listings, only valid during init()"""
+        parent, name = os.path.split(os.path.normpath(file_path))
+        return name in self._dir_listing(parent)
+
     def check_available(self, files):
         available = True
         for file in files:
@@ -196,100 +425,102 @@ class ModelManager:
                 available = False
         return available
 
-    def download_file(self, url, file_path):
+    def download_file(self, url, file_path, ranges=True, position=None):
+        """`ranges` allows parallel Range requests, `position` is the line of the progress bar"""
         # make directory
         file_path = os.path.join(self.model_base_path, file_path)
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         pbar_desc = file_path.split("/")[-1]
-        r = requests.get(url, stream=True, allow_redirects=True)
+        head = requests.head(url, allow_redirects=True, timeout=download_timeout)
+        total = int(head.headers.get("content-length", 0)) if head.ok else 0
+        with tqdm(
+            # all optional kwargs
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            miniters=1,
+            desc=pbar_desc,
+            total=total,
+            position=position,
+        ) as pbar:
+            ranges = (
+                ranges
+                and head.ok
+                and head.headers.get("accept-ranges") == "bytes"
+                and total > download_chunk_size * download_threads
+            )
+            # a server can still answer the Range requests with the whole file, that falls back to a single stream
+            if not ranges or not self.download_file_ranges(head.url, file_path, total, pbar):
+                r = requests.get(url, stream=True, allow_redirects=True, timeout=download_timeout)
+                pbar.reset(total=int(r.headers.get("content-length", 0)))
+                with open(file_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=download_chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            pbar.update(len(chunk))
+
+    def download_file_ranges(self, url, file_path, total, pbar):
+        """Downloads `total` bytes with parallel Range requests, each written into its own region of the file.
+        Returns False, without a file, when the server ignores the Range header.
+        """
         with open(file_path, "wb") as f:
-            with tqdm(
-                # all optional kwargs
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-                miniters=1,
-                desc=pbar_desc,
-                total=int(r.headers.get("content-length", 0)),
-            ) as pbar:
-                for chunk in r.iter_content(chunk_size=16 * 1024):
+            f.truncate(total)
+        pbar_lock = threading.Lock()
+
+        def download_range(start, end):
+            r = requests.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=download_timeout)
+            r.raise_for_status()
+            if r.status_code != 206:
+                r.close()
+                raise _RangesIgnored(url)
+            # every range writes through its own handle, so no seek is shared between threads
+            with open(file_path, "r+b") as f:
+                f.seek(start)
+                for chunk in r.iter_content(chunk_size=download_chunk_size):
                     if chunk:
                         f.write(chunk)
-                        pbar.update(len(chunk))
+                        with pbar_lock:
+                            pbar.update(len(chunk))
+
+        with ThreadPoolExecutor(max_workers=download_threads) as executor:
+            futures = [executor.submit(download_range, start, end) for start, end in split_ranges(total, download_threads)]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            # a preallocated file of the right size would pass check_file_available on the next attempt
+            os.remove(file_path)
+            if any(isinstance(error, _RangesIgnored) for error in errors):
+                logger.debug(f"{url} ignored the Range header, downloading it as a single stream")
+                return False
+            raise errors[0]
+        return True
 
     def download_model(self, model_name):
         if model_name in self.available_models:
             logger.info(f"{model_name} is already available.")
             return True
         download = self.get_model_download(model_name)
-        files = self.get_model_files(model_name)
-        for i in range(len(download)):
-            file_path = (
-                f"{download[i]['file_path']}/{download[i]['file_name']}"
-                if "file_path" in download[i]
-                else files[i]["path"]
-            )
-            file_path = os.path.join(self.model_base_path, file_path)
-
-            if "file_url" in download[i]:
-                download_url = download[i]["file_url"]
-                if "hf_auth" in download[i]:
-                    username = self.hf_auth["username"]
-                    password = self.hf_auth["password"]
-                    download_url = download_url.format(username=username, password=password)
-            if "file_name" in download[i]:
-                download_name = download[i]["file_name"]
-            if "file_path" in download[i]:
-                download_path = download[i]["file_path"]
-                download_path = os.path.join(self.model_base_path, download_path)
-
-            if "manual" in download[i]:
-                logger.warning(
-                    f"The model {model_name} requires manual download from {download_url}. "
-                    f"Please place it in {download_path}/{download_name} then press ENTER to continue..."
+        # get_model_files hides the files of diffusers models, their git download still needs the path
+        files = self.models[model_name]["config"]["files"]
+        entries = list(zip_longest(download, files[: len(download)]))
+        # Manual downloads wait on the user, everything else is fetched concurrently
+        for download_details, file_details in entries:
+            if "manual" in download_details:
+                self._process_download_entry(download_details, file_details, model_name)
+        automatic = [entry for entry in entries if "manual" not in entry[0]]
+        if automatic:
+            # Side by side entries download as single streams, so there are never more than download_threads
+            # connections; each keeps its own progress bar line
+            ranges = len(automatic) == 1
+            with ThreadPoolExecutor(max_workers=min(download_threads, len(automatic))) as executor:
+                list(
+                    executor.map(
+                        lambda position, entry: self._process_download_entry(
+                            *entry, model_name, ranges=ranges, position=position
+                        ),
+                        range(len(automatic)),
+                        automatic,
+                    )
                 )
-                input("")
-                continue
-            # TODO: simplify
-            if "file_content" in download[i]:
-                file_content = download[i]["file_content"]
-                logger.info(f"writing {file_content} to {file_path}")
-                # make directory download_path
-                os.makedirs(download_path, exist_ok=True)
-                # write file_content to download_path/download_name
-                with open(os.path.join(download_path, download_name), "w") as f:
-                    f.write(file_content)
-            elif "symlink" in download[i]:
-                logger.info(f"symlink {file_path} to {download[i]['symlink']}")
-                symlink = download[i]["symlink"]
-                symlink = os.path.join(self.model_base_path, symlink)
-                # make directory symlink
-                os.makedirs(download_path, exist_ok=True)
-                # make symlink from download_path/download_name to symlink
-                os.symlink(symlink, os.path.join(download_path, download_name))
-            elif "git" in download[i]:
-                logger.info(f"git clone {download_url} to {file_path}")
-                # make directory download_path
-                os.makedirs(file_path, exist_ok=True)
-                git.Git(file_path).clone(download_url)
-                if "post_process" in download[i]:
-                    for post_process in download[i]["post_process"]:
-                        if "delete" in post_process:
-                            post_process['delete'] = os.path.join(self.model_base_path, post_process['delete'])
-                            # delete folder post_process['delete']
-                            logger.info(f"delete {post_process['delete']}")
-                            try:
-                                shutil.rmtree(post_process["delete"])
-                            except PermissionError as e:
-                                logger.error(
-                                    f"[!] Something went wrong while deleting the `{post_process['delete']}`. "
-                                    "Please delete it manually."
-                                )
-                                logger.error("PermissionError: ", e)
-            else:
-                if not self.check_file_available(file_path) or model_name in self.tainted_models:
-                    logger.debug(f"Downloading {download_url} to {file_path}")
-                    self.download_file(download_url, file_path)
         if not self.validate_model(model_name):
             return False
         if model_name in self.tainted_models:
@@ -297,45 +528,120 @@ class ModelManager:
         self.init()
         return True
 
+    def _process_download_entry(self, download_details, file_details, model_name, ranges=True, position=None):
+        """Downloads, writes or links a single entry of a model's download config"""
+        file_path = (
+            f"{download_details['file_path']}/{download_details['file_name']}"
+            if "file_path" in download_details
+            else file_details["path"]
+        )
+        file_path = os.path.join(self.model_base_path, file_path)
+
+        download_url = download_details.get("file_url")
+        if download_url and "hf_auth" in download_details:
+            username = self.hf_auth["username"]
+            password = self.hf_auth["password"]
+            download_url = download_url.format(username=username, password=password)
+        download_name = download_details.get("file_name")
+        download_path = download_details.get("file_path")
+        if download_path:
+            download_path = os.path.join(self.model_base_path, download_path)
+
+        if "manual" in download_details:
+            logger.warning(
+                f"The model {model_name} requires manual download from {download_url}. "
+                f"Please place it in {download_path}/{download_name} then press ENTER to continue..."
+            )
+            input("")
+            return
+        # TODO: simplify
+        if "file_content" in download_details:
+            file_content = download_details["file_content"]
+            logger.info(f"writing {file_content} to {file_path}")
+            # make directory download_path
+            os.makedirs(download_path, exist_ok=True)
+            # write file_content to download_path/download_name
+            with open(os.path.join(download_path, download_name), "w") as f:
+                f.write(file_content)
+        elif "symlink" in download_details:
+            logger.info(f"symlink {file_path} to {download_details['symlink']}")
+            symlink = download_details["symlink"]
+            symlink = os.path.join(self.model_base_path, symlink)
+            # make directory symlink
+            os.makedirs(download_path, exist_ok=True)
+            # make symlink from download_path/download_name to symlink
+            os.symlink(symlink, os.path.join(download_path, download_name))
+        elif "git" in download_details and snapshot_download is not None and is_huggingface_url(download_url):
+            # Only the files of the last revision, in parallel and resumable, no .git to delete afterwards
+            repo_id = urlparse(download_url).path.strip("/")
+            if repo_id.endswith(".git"):
+                repo_id = repo_id[: -len(".git")]
+            local_dir = os.path.join(file_path, repo_id.split("/")[-1])
+            logger.info(f"snapshot download {repo_id} to {local_dir}")
+            snapshot_download(
+                repo_id,
+                local_dir=local_dir,
+                max_workers=8,
+                token=self.hf_auth["password"] if self.hf_auth else None,
+            )
+        elif "git" in download_details:
+            logger.info(f"git clone {download_url} to {file_path}")
+            # make directory download_path
+            os.makedirs(file_path, exist_ok=True)
+            # no history and no blobs beyond the checked out revision
+            git.Git(file_path).clone(download_url, depth=1, filter="blob:none")
+            if "post_process" in download_details:
+                for post_process in download_details["post_process"]:
+                    if "delete" in post_process:
+                        # the reference entries are shared between managers, never write to them
+                        delete_path = os.path.join(self.model_base_path, post_process["delete"])
+                        logger.info(f"delete {delete_path}")
+                        try:
+                            shutil.rmtree(delete_path)
+                        except PermissionError as e:
+                            logger.error(
+                                f"[!] Something went wrong while deleting the `{delete_path}`. "
+                                "Please delete it manually."
+                            )
+                            logger.error("PermissionError: ", e)
+        else:
+            if not self.check_file_available(file_path) or model_name in self.tainted_models:
+                logger.debug(f"Downloading {download_url} to {file_path}")
+                self.download_file(download_url, file_path, ranges=ranges, position=position)
+
     def download_dependency(self, dependency_name):
         if dependency_name in self.available_dependencies:
             logger.info(f"{dependency_name} is already installed.")
             return True
         download = self.get_dependency_download(dependency_name)
         files = self.get_dependency_files(dependency_name)
-        for i in range(len(download)):
-            if "git" in download[i]:
+        for download_details, file_details in zip(download, files):
+            if "git" in download_details:
                 logger.warning("git download not implemented yet")
                 break
 
-            file_path = files[i]["path"]
+            file_path = file_details["path"]
             file_path = os.path.join(self.model_base_path, file_path)
-            if "file_url" in download[i]:
-                download_url = download[i]["file_url"]
-            if "file_name" in download[i]:
-                download_name = download[i]["file_name"]
-            if "file_path" in download[i]:
-                download_path = download[i]["file_path"]
+            if "file_url" in download_details:
+                download_url = download_details["file_url"]
+            if "file_name" in download_details:
+                download_name = download_details["file_name"]
+            if "file_path" in download_details:
+                download_path = download_details["file_path"]
                 download_path = os.path.join(self.model_base_path, download_path)
             logger.debug(download_name)
-            if "unzip" in download[i]:
-                zip_path = f"temp/{download_name}.zip"
-                zip_path = os.path.join(self.model_base_path, zip_path)
-                # os dirname zip_path
-                # mkdir temp
-                os.makedirs(os.path.join(self.model_base_path, "temp"), exist_ok=True)
-
-                self.download_file(download_url, zip_path)
-                logger.info(f"unzip {zip_path}")
-                with zipfile.ZipFile(zip_path, "r") as zip_ref:
-                    zip_ref.extractall("temp/")
-                # move temp/sd-concepts-library-main/sd-concepts-library to download_path
-                logger.info(f"move temp/{download_name}-main/{download_name} to {download_path}")
-                shutil.move(f"{self.model_base_path}/temp/{download_name}-main/{download_name}", download_path)
-                logger.info(f"delete {zip_path}")
-                os.remove(zip_path)
-                logger.info(f"delete temp/{download_name}-main/")
-                shutil.rmtree(f"{self.model_base_path}/temp/{download_name}-main")
+            if "unzip" in download_details:
+                # The archive goes to an anonymous temporary file and only
+                # {download_name}-main/{download_name}/ is written out, straight to download_path
+                logger.info(f"Downloading {download_url}")
+                with tempfile.TemporaryFile() as archive:
+                    with requests.get(download_url, stream=True, allow_redirects=True, timeout=download_timeout) as r:
+                        r.raise_for_status()
+                        for chunk in r.iter_content(chunk_size=download_chunk_size):
+                            archive.write(chunk)
+                    logger.info(f"unzip {download_name}-main/{download_name} to {download_path}")
+                    with zipfile.ZipFile(archive) as zip_ref:
+                        extract_subfolder(zip_ref, f"{download_name}-main/{download_name}/", download_path)
             else:
                 if not self.check_file_available(file_path):
                     logger.init(f"{file_path}", status="Downloading")
@@ -369,7 +675,9 @@ class ModelManager:
     def check_model_available(self, model_name):
         if model_name not in self.models:
             return False
-        return self.check_available(self.get_model_files(model_name))
+        if self._files_by_model is None:
+            self._build_files_by_model()
+        return all(map(os.path.exists, self._files_by_model.get(model_name, ())))
 
     def check_dependency_available(self, dependency_name):
         if dependency_name not in self.dependencies:
@@ -1 +1 @@
-from .blip import blip_decoder
\ No newline at end of file
+from .blip import blip_decoder, load_checkpoint
\ No newline at end of file
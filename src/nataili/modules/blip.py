@@ -18,6 +18,7 @@ from torch import nn
 import os
 from urllib.parse import urlparse
 from timm.models.hub import download_cached_file
+from nataili.util import load_state_dict_lazily, load_weights
 
 class BLIP_Base(nn.Module):
     def __init__(self,                 
@@ -168,10 +169,10 @@ class BLIP_Decoder(nn.Module):
         return captions
     
 
-def blip_decoder(pretrained='',**kwargs):
+def blip_decoder(pretrained='',device=None,dtype=None,**kwargs):
     model = BLIP_Decoder(**kwargs)
     if pretrained:
-        model,msg = load_checkpoint(model,pretrained)
+        model,msg = load_checkpoint(model,pretrained,device=device,dtype=dtype)
         assert(len(msg.missing_keys)==0)
     return model    
     
@@ -211,26 +212,36 @@ def is_url(url_or_filename):
     parsed = urlparse(url_or_filename)
     return parsed.scheme in ("http", "https")
 
-def load_checkpoint(model,url_or_filename):
+def load_checkpoint(model,url_or_filename,device=None,dtype=None):
     if is_url(url_or_filename):
         cached_file = download_cached_file(url_or_filename, check_hash=False, progress=True)
         checkpoint = torch.load(cached_file, map_location='cpu') 
     elif os.path.isfile(url_or_filename):        
-        checkpoint = torch.load(url_or_filename, map_location='cpu') 
+        checkpoint = load_weights(url_or_filename, map_location='cpu') 
     else:
         raise RuntimeError('checkpoint url or path is invalid')
         
-    state_dict = checkpoint['model']
+    # converted .safetensors checkpoints only hold the model state dict
+    state_dict = checkpoint['model'] if 'model' in checkpoint else checkpoint
     
+    model_state_dict = model.state_dict()
     state_dict['visual_encoder.pos_embed'] = interpolate_pos_embed(state_dict['visual_encoder.pos_embed'],model.visual_encoder) 
-    if 'visual_encoder_m.pos_embed' in model.state_dict().keys():
+    if 'visual_encoder_m.pos_embed' in model_state_dict:
         state_dict['visual_encoder_m.pos_embed'] = interpolate_pos_embed(state_dict['visual_encoder_m.pos_embed'],
                                                                          model.visual_encoder_m)    
-    for key in model.state_dict().keys():
-        if key in state_dict.keys():
-            if state_dict[key].shape!=model.state_dict()[key].shape:
+    for key in model_state_dict:
+        if key in state_dict:
+            if state_dict[key].shape!=model_state_dict[key].shape:
                 del state_dict[key]
     
-    msg = model.load_state_dict(state_dict,strict=False)
+    if device is not None or dtype is not None or any(p.is_meta for p in model.parameters()):
+        # module by module: cast on the host so only the target precision crosses the bus, then assign the moved
+        # tensors to the (meta) parameters instead of copying them into freshly built ones
+        msg = load_state_dict_lazily(model, state_dict, device or 'cpu', dtype)
+        if hasattr(model, 'text_decoder'):
+            # the decoder shares the word embedding weight
+            model.text_decoder.tie_weights()
+    else:
+        msg = model.load_state_dict(state_dict,strict=False)
     print('load checkpoint from %s'%url_or_filename)  
     return model,msg
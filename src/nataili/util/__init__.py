@@ -1,2 +1,3 @@
 from .performance import performance
-from .logger import logger
\ No newline at end of file
+from .logger import logger
+from .weights import convert_to_safetensors, load_state_dict_lazily, load_weights
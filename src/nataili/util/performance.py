@@ -5,8 +5,19 @@ import torch
 
 T = TypeVar("T")
 
+
+def autocast(args):
+    """Autocast for the device of the decorated method's instance (bfloat16 on cpu), cuda when it has none"""
+    device = getattr(args[0], "device", None) if args else None
+    if device is not None and torch.device(device).type == "cpu":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return torch.autocast("cuda")
+
+
 def performance(function: T) -> T:
     @wraps(function)
     def wrapper(*args, **kwargs):
-        return torch.cuda.amp.autocast()(torch.no_grad()(function))(*args, **kwargs)
+        # inference_mode also skips the view tracking and version counter bumps no_grad still does
+        with torch.inference_mode(), autocast(args):
+            return function(*args, **kwargs)
     return wrapper
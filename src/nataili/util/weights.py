@@ -0,0 +1,153 @@
+import os
+import pickle
+
+import torch
+from torch.nn.modules.module import _IncompatibleKeys
+
+from .logger import logger
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import load_file, save_file
+except ImportError:
+    safe_open = load_file = save_file = None
+
+
+def load_weights(file_path, map_location="cpu"):
+    """Load a `.safetensors` or pickled checkpoint without reading it into memory up front.
+    Both formats are memory mapped, so pages are only read from disk once they are touched.
+    """
+    if str(file_path).endswith(".safetensors"):
+        return load_file(file_path, device=str(map_location))
+    try:
+        return torch.load(file_path, map_location=map_location, mmap=True, weights_only=True)
+    except pickle.UnpicklingError:
+        # Older checkpoints pickle more than tensors (training config, optimizer state...),
+        # torch >= 2.6 defaults to weights_only=True so the full unpickle has to be asked for
+        return torch.load(file_path, map_location=map_location, mmap=True, weights_only=False)
+
+
+def convert_to_safetensors(file_path, key=None):
+    """Write a `.safetensors` copy of a pickled checkpoint next to it, rebuilt whenever the source file changes.
+    `key` selects the state dict inside the checkpoint, e.g. "model".
+    Returns the path of the converted file, or None when safetensors is not installed.
+    """
+    if save_file is None:
+        return None
+    converted_path = os.path.splitext(file_path)[0] + ".safetensors"
+    stat = os.stat(file_path)
+    source = {"source_size": str(stat.st_size), "source_mtime_ns": str(stat.st_mtime_ns)}
+    if os.path.exists(converted_path):
+        try:
+            with safe_open(converted_path, framework="pt") as converted:
+                metadata = converted.metadata() or {}
+        except Exception:
+            metadata = {}
+        if all(metadata.get(name) == value for name, value in source.items()):
+            return converted_path
+        logger.info(f"{file_path} changed, rebuilding {converted_path}")
+    else:
+        logger.info(f"Converting {file_path} to {converted_path}, this keeps a second copy of the weights on disk")
+    state_dict = load_weights(file_path)
+    if key is not None:
+        state_dict = state_dict[key]
+    # safetensors refuses tensors that share storage, tied weights get their own copy
+    state_dict = {k: v.detach().clone().contiguous() for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+    temp_path = f"{converted_path}.tmp"
+    save_file(state_dict, temp_path, metadata=source)
+    os.replace(temp_path, converted_path)
+    return converted_path
+
+
+class _PinnedTransfer:
+    """Host to device copies through pinned staging memory, one async copy per call.
+    Two staging buffers alternate so packing the next batch overlaps the transfer of the previous one.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.staging = [None, None]
+        self.events = [None, None]
+        self.turn = 0
+
+    def __call__(self, tensors):
+        layout = []
+        size = 0
+        for key, (value, dtype) in tensors.items():
+            # keep every tensor aligned so the byte buffer can be viewed as any dtype
+            start = -(-size // 16) * 16
+            size = start + value.numel() * dtype.itemsize
+            layout.append((key, value, dtype, start, size))
+        turn = self.turn
+        self.turn ^= 1
+        if self.events[turn] is not None:
+            self.events[turn].synchronize()
+        if self.staging[turn] is None or self.staging[turn].numel() < size:
+            self.staging[turn] = torch.empty(size, dtype=torch.uint8, pin_memory=True)
+        staging = self.staging[turn]
+        for key, value, dtype, start, end in layout:
+            staging[start:end].view(dtype).view(value.shape).copy_(value)
+        flat = torch.empty(size, dtype=torch.uint8, device=self.device)
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            flat.copy_(staging[:size], non_blocking=True)
+            self.events[turn] = torch.cuda.Event()
+            self.events[turn].record(self.stream)
+        return {key: flat[start:end].view(dtype).view(value.shape) for key, value, dtype, start, end in layout}
+
+    def synchronize(self):
+        self.stream.synchronize()
+
+
+def load_state_dict_lazily(model, state_dict, device, dtype=None):
+    """Fill the parameters and buffers of `model` from `state_dict` one module at a time, casting floating point
+    tensors to `dtype` and moving them to `device` as each module is reached.
+    Meant for models built under `torch.device("meta")` and memory mapped state dicts: at most a module's worth of
+    weights is resident in host memory. For CUDA each module is sent with a single pinned async copy.
+    Returns the missing and unexpected keys like `torch.nn.Module.load_state_dict`.
+    """
+    device = torch.device(device)
+    transfer = _PinnedTransfer(device) if device.type == "cuda" else None
+    remaining = dict(state_dict)
+    # tied parameters are a single Parameter reachable from several modules, materialize it once
+    materialized = {}
+    missing_keys = []
+    for module_name, module in model.named_modules():
+        prefix = f"{module_name}." if module_name else ""
+        tensors = {}
+        for kind, members in (("parameter", module._parameters), ("buffer", module._buffers)):
+            for name, current in members.items():
+                if current is None:
+                    continue
+                key = prefix + name
+                if kind == "parameter" and id(current) in materialized:
+                    members[name] = materialized[id(current)]
+                    remaining.pop(key, None)
+                elif key in remaining:
+                    value = remaining.pop(key)
+                    target_dtype = dtype if dtype is not None and value.is_floating_point() else value.dtype
+                    tensors[(kind, name)] = (value, target_dtype)
+                elif kind == "buffer" and name in module._non_persistent_buffers_set and not current.is_meta:
+                    # not part of checkpoints, it only follows the model to `device` and `dtype`
+                    target_dtype = dtype if dtype is not None and current.is_floating_point() else current.dtype
+                    tensors[(kind, name)] = (current, target_dtype)
+                else:
+                    # meta buffers included, the checkpoint is the only data there is to materialize them from
+                    missing_keys.append(key)
+        if not tensors:
+            continue
+        if transfer is not None:
+            moved = transfer(tensors)
+        else:
+            moved = {key: value.to(device=device, dtype=target_dtype) for key, (value, target_dtype) in tensors.items()}
+        for (kind, name), tensor in moved.items():
+            if kind == "parameter":
+                param = torch.nn.Parameter(tensor, requires_grad=False)
+                materialized[id(module._parameters[name])] = param
+                module._parameters[name] = param
+            else:
+                module._buffers[name] = tensor
+    if transfer is not None:
+        transfer.synchronize()
+    return _IncompatibleKeys(missing_keys, list(remaining))
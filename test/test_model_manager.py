@@ -0,0 +1,273 @@
+import hashlib
+import io
+import os
+import zipfile
+
+from torch import nn
+from tqdm import tqdm
+
+from nataili.model_manager import modelmanager
+from nataili.model_manager.modelmanager import ModelManager, extract_subfolder, split_ranges
+
+test_models = {
+    "a": {"type": "ckpt", "nsfw": False, "requires": ["x", "y"], "config": {"files": [{"path": "a.ckpt"}]}},
+    "b": {"type": "ckpt", "nsfw": True, "requires": ["x"], "style": "anime"},
+    "c": {"type": "diffusers", "nsfw": False, "requires": ["x", "y"], "config": {"files": [{"path": "a.ckpt"}]}},
+    "d": {"type": "ckpt", "style": None},
+}
+
+
+def nested_loop_filter(models, **kwargs):
+    filtered_models = models
+    for keyword in kwargs:
+        iterating_models = filtered_models.copy()
+        filtered_models = {}
+        for model in iterating_models:
+            if iterating_models[model].get(keyword) == kwargs[keyword]:
+                filtered_models[model] = iterating_models[model]
+    return filtered_models
+
+
+def test_filtered_models_match_nested_loop(tmp_path):
+    model_manager = ModelManager(download=False, model_base_path=str(tmp_path))
+    filters = [
+        {},
+        {"type": "ckpt"},
+        {"type": "ckpt", "nsfw": False},
+        {"nsfw": None},
+        {"style": None},
+        {"style": "anime", "type": "ckpt"},
+        {"requires": ["x", "y"]},
+        {"requires": ["y", "x"]},
+        {"config": {"files": [{"path": "a.ckpt"}]}},
+        {"type": "missing"},
+        {"unknown_keyword": None},
+    ]
+    for models in (test_models, model_manager.models):
+        model_manager.models = models
+        for kwargs in filters:
+            filtered_models = model_manager.get_filtered_models(**kwargs)
+            expected = nested_loop_filter(models, **kwargs)
+            assert list(filtered_models) == list(expected), kwargs
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200, headers=None, url=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.ok = status_code < 400
+        self.url = url
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+def make_archive(members):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_ref:
+        for name, content in members.items():
+            zip_ref.writestr(name, content)
+    return archive.getvalue()
+
+
+def test_extract_subfolder(tmp_path):
+    archive = make_archive(
+        {
+            "repo-main/wanted/a.txt": "a",
+            "repo-main/wanted/nested/b.txt": "b",
+            "repo-main/other/c.txt": "c",
+            "repo-main/wanted/../../escaped.txt": "escaped",
+            "repo-main/wanted//tmp/absolute.txt": "absolute",
+        }
+    )
+    # deep enough that a "../../" member would still land inside tmp_path
+    destination = tmp_path / "dependencies" / "destination"
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_ref:
+        extract_subfolder(zip_ref, "repo-main/wanted/", str(destination))
+
+    extracted = sorted(
+        os.path.relpath(os.path.join(root, name), tmp_path) for root, _, names in os.walk(tmp_path) for name in names
+    )
+    assert extracted == [
+        os.path.join("dependencies", "destination", "a.txt"),
+        os.path.join("dependencies", "destination", "nested", "b.txt"),
+    ]
+    assert (destination / "nested" / "b.txt").read_text() == "b"
+
+
+def test_download_dependency_unzips_subfolder(tmp_path, monkeypatch):
+    archive = make_archive(
+        {
+            "sd-concepts-library-main/sd-concepts-library/concept/learned_embeds.bin": "embeds",
+            "sd-concepts-library-main/README.md": "readme",
+        }
+    )
+    monkeypatch.setattr(modelmanager.requests, "get", lambda *args, **kwargs: FakeResponse(archive))
+    model_manager = ModelManager(download=False, model_base_path=str(tmp_path))
+    assert model_manager.download_dependency("sd-concepts-library")
+
+    destination = tmp_path / "models" / "custom" / "sd-concepts-library"
+    assert (destination / "concept" / "learned_embeds.bin").read_text() == "embeds"
+    assert not (destination / "README.md").exists()
+    assert "sd-concepts-library" in model_manager.available_dependencies
+
+
+def test_split_ranges_cover_every_byte_once():
+    for total in (1, 7, 8, 9, 1024 * 1024 + 3):
+        for parts in (1, 3, 8, 16):
+            ranges = split_ranges(total, parts)
+            assert len(ranges) <= parts
+            assert ranges[0][0] == 0 and ranges[-1][1] == total - 1
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                assert start == end + 1
+
+
+def fake_server(monkeypatch, content, head_status=200, honour_ranges=True):
+    requested = []
+    bars = []
+
+    def head(url, **kwargs):
+        headers = {"content-length": str(len(content)), "accept-ranges": "bytes"}
+        return FakeResponse(b"", head_status, headers, url=url)
+
+    def get(url, headers=None, **kwargs):
+        requested.append((headers or {}).get("Range"))
+        if headers and honour_ranges:
+            start, end = map(int, headers["Range"][len("bytes=") :].split("-"))
+            return FakeResponse(content[start : end + 1], 206)
+        return FakeResponse(content, 200, {"content-length": str(len(content))})
+
+    class RecordingTqdm(tqdm):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.position = kwargs.get("position")
+            bars.append(self)
+
+    monkeypatch.setattr(modelmanager.requests, "head", head)
+    monkeypatch.setattr(modelmanager.requests, "get", get)
+    monkeypatch.setattr(modelmanager, "tqdm", RecordingTqdm)
+    monkeypatch.setattr(modelmanager, "download_chunk_size", 16)
+    return requested, bars
+
+
+def test_download_file_ranges(tmp_path, monkeypatch):
+    content = bytes(range(256)) * 4
+    requested, bars = fake_server(monkeypatch, content)
+    ModelManager(download=False, model_base_path=str(tmp_path)).download_file("http://host/model.ckpt", "model.ckpt")
+    assert (tmp_path / "model.ckpt").read_bytes() == content
+    assert len(requested) == modelmanager.download_threads and None not in requested
+    assert bars[0].n == bars[0].total == len(content)
+
+
+def test_download_file_falls_back_when_ranges_are_ignored(tmp_path, monkeypatch):
+    content = bytes(range(256)) * 4
+    requested, bars = fake_server(monkeypatch, content, honour_ranges=False)
+    ModelManager(download=False, model_base_path=str(tmp_path)).download_file("http://host/model.ckpt", "model.ckpt")
+    assert (tmp_path / "model.ckpt").read_bytes() == content
+    assert requested[-1] is None
+    assert bars[0].n == bars[0].total == len(content)
+
+
+def test_download_file_without_head(tmp_path, monkeypatch):
+    content = bytes(range(256)) * 4
+    requested, bars = fake_server(monkeypatch, content, head_status=405)
+    ModelManager(download=False, model_base_path=str(tmp_path)).download_file("http://host/model.ckpt", "model.ckpt")
+    assert (tmp_path / "model.ckpt").read_bytes() == content
+    assert requested == [None]
+    # the size comes from the GET response when HEAD is refused
+    assert bars[0].n == bars[0].total == len(content)
+
+
+def test_download_model_entries_share_the_connections(tmp_path, monkeypatch):
+    content = bytes(range(256)) * 4
+    requested, bars = fake_server(monkeypatch, content)
+    model_manager = ModelManager(download=False, model_base_path=str(tmp_path))
+    model_manager.models = {
+        "test": {
+            "type": "ckpt",
+            "config": {
+                "files": [{"path": "models/a.ckpt"}, {"path": "models/b.ckpt"}],
+                "download": [
+                    {"file_name": "a.ckpt", "file_path": "models", "file_url": "http://host/a.ckpt"},
+                    {"file_name": "b.ckpt", "file_path": "models", "file_url": "http://host/b.ckpt"},
+                ],
+            },
+        }
+    }
+    assert model_manager.download_model("test")
+    assert (tmp_path / "models" / "a.ckpt").read_bytes() == content
+    assert (tmp_path / "models" / "b.ckpt").read_bytes() == content
+    # concurrent entries do not each open download_threads Range requests
+    assert requested == [None, None]
+    assert sorted(bar.position for bar in bars) == [0, 1]
+
+
+def test_unload_all_models(tmp_path):
+    model_manager = ModelManager(download=False, model_base_path=str(tmp_path))
+    model_manager.loaded_models = {
+        "first": {"model": nn.Linear(2, 2), "device": "cpu"},
+        "second": {"model": nn.Linear(2, 2), "device": "cpu"},
+    }
+    assert model_manager.unload_all_models()
+    assert model_manager.loaded_models == {}
+
+
+def test_validate_file_sidecar_cache(tmp_path, monkeypatch):
+    hashed = []
+    file_digest = modelmanager.file_digest
+
+    def counting_file_digest(file_obj, digest):
+        hashed.append(digest)
+        return file_digest(file_obj, digest)
+
+    monkeypatch.setattr(modelmanager, "file_digest", counting_file_digest)
+    file_path = tmp_path / "model.ckpt"
+    file_path.write_bytes(b"weights" * 100)
+    file_details = {"path": "model.ckpt", "md5sum": hashlib.md5(b"weights" * 100).hexdigest()}
+
+    model_manager = ModelManager(download=False, model_base_path=str(tmp_path))
+    assert model_manager.validate_file(file_details)
+    assert len(hashed) == 1
+    # a fresh manager picks the result up from the sidecar
+    assert ModelManager(download=False, model_base_path=str(tmp_path)).validate_file(file_details)
+    assert len(hashed) == 1
+
+    # same size, different mtime
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert model_manager.validate_file(file_details)
+    assert len(hashed) == 2
+
+    # different size
+    file_path.write_bytes(b"weights" * 101)
+    assert not model_manager.validate_file(file_details)
+    assert len(hashed) == 3
+    assert not model_manager.validate_file(file_details)
+    assert len(hashed) == 4
+
+
+def test_sidecar_keeps_entries_of_other_managers(tmp_path):
+    for name in ("a.ckpt", "b.ckpt"):
+        (tmp_path / name).write_bytes(name.encode())
+    first = ModelManager(download=False, model_base_path=str(tmp_path))
+    second = ModelManager(download=False, model_base_path=str(tmp_path))
+    assert first.validate_file({"path": "a.ckpt", "md5sum": hashlib.md5(b"a.ckpt").hexdigest()})
+    assert second.validate_file({"path": "b.ckpt", "md5sum": hashlib.md5(b"b.ckpt").hexdigest()})
+
+    validated = modelmanager.json_loads((tmp_path / ".validated.json").read_bytes())
+    assert sorted(validated) == [str(tmp_path / "a.ckpt"), str(tmp_path / "b.ckpt")]
+    assert [path.name for path in tmp_path.iterdir() if path.name.startswith(".validated")] == [".validated.json"]
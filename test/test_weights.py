@@ -0,0 +1,76 @@
+import pytest
+import torch
+from torch import nn
+
+from nataili.util import load_state_dict_lazily
+
+devices = ["cpu", pytest.param("cuda", marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA"))]
+
+
+class TiedModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embeddings = nn.Embedding(16, 8)
+        self.norm = nn.LayerNorm(8)
+        self.head = nn.Linear(8, 16)
+        self.head.weight = self.embeddings.weight
+        self.register_buffer("position_ids", torch.arange(16).expand((1, -1)))
+        self.register_buffer("scale", torch.full((8,), 0.5), persistent=False)
+
+
+def reference_model(device, dtype):
+    torch.manual_seed(0)
+    model = TiedModel()
+    state_dict = {key: value.clone() for key, value in model.state_dict().items()}
+    with torch.no_grad():
+        for param in model.parameters():
+            param.zero_()
+    incompatible_keys = model.load_state_dict(state_dict, strict=False)
+    return model.to(device=device, dtype=dtype), state_dict, incompatible_keys
+
+
+def assert_same_tensors(model, expected):
+    tensors = dict(model.named_parameters(remove_duplicate=False))
+    tensors.update(model.named_buffers())
+    expected_tensors = dict(expected.named_parameters(remove_duplicate=False))
+    expected_tensors.update(expected.named_buffers())
+    assert tensors.keys() == expected_tensors.keys()
+    for key, tensor in tensors.items():
+        assert tensor.device == expected_tensors[key].device, key
+        assert tensor.dtype == expected_tensors[key].dtype, key
+        assert torch.equal(tensor, expected_tensors[key]), key
+
+
+@pytest.mark.parametrize("device", devices)
+@pytest.mark.parametrize("dtype", [None, torch.float16])
+def test_lazy_load_matches_load_state_dict(device, dtype):
+    expected, state_dict, expected_keys = reference_model(device, dtype)
+    state_dict["unused.weight"] = torch.zeros(1)
+
+    torch.manual_seed(1)
+    model = TiedModel()
+    incompatible_keys = load_state_dict_lazily(model, state_dict, device, dtype)
+
+    assert_same_tensors(model, expected)
+    assert model.head.weight is model.embeddings.weight
+    assert incompatible_keys.missing_keys == expected_keys.missing_keys
+    assert incompatible_keys.unexpected_keys == ["unused.weight"]
+
+
+@pytest.mark.parametrize("device", devices)
+@pytest.mark.parametrize("dtype", [None, torch.float16])
+def test_lazy_load_materializes_meta_model(device, dtype):
+    expected, state_dict, _ = reference_model(device, dtype)
+
+    with torch.device("meta"):
+        model = TiedModel()
+    incompatible_keys = load_state_dict_lazily(model, state_dict, device, dtype)
+
+    # non-persistent buffers are not in checkpoints, built on meta they have nothing to be loaded from
+    assert incompatible_keys.missing_keys == ["scale"]
+    assert incompatible_keys.unexpected_keys == []
+    assert model.scale.is_meta
+    model.scale = expected.scale
+    assert_same_tensors(model, expected)
+    assert model.head.weight is model.embeddings.weight
+    assert not any(param.is_meta for param in model.parameters())